@@ -1,18 +1,59 @@
-import re
+import asyncio
+import time
 from fastapi import FastAPI, HTTPException, Query
-from elasticsearch import Elasticsearch
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.serializer import OrjsonSerializer
 from contextlib import asynccontextmanager
 import uvicorn
 from typing import Optional
-from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from cachetools import TTLCache
+import orjson
+import redis.asyncio as redis
 
 # --- 設定 ---
 # ご自身の環境に合わせて変更してください
 ELASTICSEARCH_HOSTS = ["http://localhost:9200"] 
-INDEX_NAME = "pukiwiki"  # 検索対象のElasticsearchインデックス名
+INDEX_NAME = "pukiwiki_v2"  # 検索対象のElasticsearchインデックス名 (crawler/config.py の INDEX と合わせる)
+MAX_LINKS_PER_PAGE = 100  # 1ページあたりに返すリンク行数の上限 (index.max_inner_result_window の既定値)
+MAX_RESULT_WINDOW = 10000  # Elasticsearchの index.max_result_window (from + size の上限)
+SEARCH_CACHE_MAXSIZE = 1024  # 検索結果キャッシュの最大件数
+SEARCH_CACHE_TTL = 60  # 検索結果キャッシュの有効期間 (秒)
+REDIS_URL = "redis://localhost:6379/0"  # ワーカー間で共有する検索結果キャッシュ
+SEARCH_CACHE_PREFIX = "wiki_search:"  # Redis上のキャッシュキーの接頭辞
+# 検索結果キャッシュの世代番号のキー。クローラーが再インデックス後にINCRし、古い世代のキャッシュは参照されなくなる
+# (crawler/config.py の SEARCH_CACHE_GENERATION_KEY と合わせる)
+SEARCH_CACHE_GENERATION_KEY = "wiki_search:generation"
+REDIS_TIMEOUT = 0.5  # Redisの接続・応答待ちの上限 (秒)。超えた場合はキャッシュミスとして扱う
+REDIS_COOLDOWN = 30  # Redisの障害後、プロセス内のキャッシュで代替する期間 (秒)
+
+# 現在の世代番号を読み、その世代のキャッシュをまとめて取得する (1往復で済ませるためLuaで実行)
+# KEYS[1]: 世代番号のキー, ARGV[1]: 接頭辞, ARGV[2..]: キャッシュキー
+_GET_CACHED_SCRIPT = """
+local generation = redis.call('GET', KEYS[1]) or '0'
+local keys = {}
+for i = 2, #ARGV do
+    keys[#keys + 1] = ARGV[1] .. generation .. ':' .. ARGV[i]
+end
+return redis.call('MGET', unpack(keys))
+"""
+# 現在の世代番号でキャッシュを登録する
+# KEYS[1]: 世代番号のキー, ARGV[1]: 接頭辞, ARGV[2]: キャッシュキー, ARGV[3]: 値, ARGV[4]: 有効期間 (秒)
+_SET_CACHED_SCRIPT = """
+local generation = redis.call('GET', KEYS[1]) or '0'
+redis.call('SET', ARGV[1] .. generation .. ':' .. ARGV[2], ARGV[3], 'EX', ARGV[4])
+"""
 
 # --- グローバル変数 ---
 es_client = None
+redis_client = None
+_get_cached_script = None
+_set_cached_script = None
+_redis_retry_at = 0.0  # この時刻 (time.monotonic) まではRedisを使わない
+# (エンドポイント名, [ページ番号, 件数,] 検索キーワード) をキーに、整形済みのレスポンスを保持する
+# Redisに接続できない場合や障害中は、このプロセス内のキャッシュを使う (再インデックス後もTTLまでは古い結果を返す)
+_search_cache = TTLCache(maxsize=SEARCH_CACHE_MAXSIZE, ttl=SEARCH_CACHE_TTL)
+_search_cache_lock = asyncio.Lock()
 
 # --- FastAPIのライフサイクル管理 ---
 @asynccontextmanager
@@ -21,24 +62,47 @@ async def lifespan(app: FastAPI):
     アプリケーションの起動時と終了時に実行される処理を定義します。
     """
     # 起動時の処理
-    global es_client
+    global es_client, redis_client, _get_cached_script, _set_cached_script
     try:
         # Elasticsearchに接続
-        es_client = Elasticsearch(hosts=ELASTICSEARCH_HOSTS)
-        if not es_client.ping():
+        es_client = AsyncElasticsearch(hosts=ELASTICSEARCH_HOSTS, serializer=OrjsonSerializer())
+        if not await es_client.ping():
             raise ConnectionError("Could not connect to Elasticsearch.")
         print("Successfully connected to Elasticsearch.")
     except Exception as e:
         print(f"Error connecting to Elasticsearch: {e}")
         # 接続に失敗した場合はNoneのままにしておく
+        if es_client:
+            await es_client.close()
         es_client = None
+
+    try:
+        # Redisに接続
+        redis_client = redis.Redis.from_url(
+            REDIS_URL,
+            socket_timeout=REDIS_TIMEOUT,
+            socket_connect_timeout=REDIS_TIMEOUT
+        )
+        await redis_client.ping()
+        _get_cached_script = redis_client.register_script(_GET_CACHED_SCRIPT)
+        _set_cached_script = redis_client.register_script(_SET_CACHED_SCRIPT)
+        print("Successfully connected to Redis.")
+    except Exception as e:
+        print(f"Error connecting to Redis: {e}")
+        # 接続に失敗した場合はプロセス内のキャッシュを使う
+        if redis_client:
+            await redis_client.aclose()
+        redis_client = None
     
     yield
     
     # 終了時の処理
     if es_client:
-        es_client.close()
+        await es_client.close()
         print("Elasticsearch connection closed.")
+    if redis_client:
+        await redis_client.aclose()
+        print("Redis connection closed.")
 
 # FastAPIアプリケーションのインスタンスを作成
 app = FastAPI(
@@ -48,41 +112,260 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# --- レスポンスモデル ---
+# 戻り値の型を宣言することで、FastAPIはPydanticで直接JSONにシリアライズする
+class SearchResponse(BaseModel):
+    """`/search` のレスポンス"""
+    query: str
+    results: list[str]
+
+class FileListItem(BaseModel):
+    """`/search_file_list` の結果1件"""
+    id: str
+    title: str
+    count: int
+    score: Optional[float]
+
+class FileListResponse(BaseModel):
+    """`/search_file_list` のレスポンス"""
+    query: str
+    total: int
+    results: list[FileListItem]
+
+class CombinedResponse(BaseModel):
+    """`/search_combined` のレスポンス"""
+    query: str
+    search: SearchResponse
+    file_list: FileListResponse
+
 # --- ヘルパー関数 ---
-def parse_wiki_body(body_text: str, keyword: str) -> list[str]:
+def _redis_key(key: tuple) -> str:
     """
-    与えられたwikiのbodyテキストから、キーワードにマッチする行のページタイトルを抽出します。
-    
+    キャッシュキーをRedis上のキー文字列 (接頭辞と世代番号を除く部分) に変換します。
+    """
+    # 検索キーワードは常にキーの末尾に置くため、区切り文字を含んでいても衝突しない
+    return ":".join(str(part) for part in key)
+
+def _use_redis() -> bool:
+    """
+    Redisのキャッシュを使うかどうかを返します。障害後の一定期間は使いません。
+    """
+    return redis_client is not None and time.monotonic() >= _redis_retry_at
+
+def _on_redis_error(action: str, e: Exception) -> None:
+    """
+    Redisの障害を記録し、`REDIS_COOLDOWN` 秒間はプロセス内のキャッシュで代替させます。
+    """
+    global _redis_retry_at
+    # 障害中に毎回タイムアウトまで待たないよう、しばらくRedisを使わない
+    _redis_retry_at = time.monotonic() + REDIS_COOLDOWN
+    print(f"Error {action} search cache in Redis, using in-process cache for {REDIS_COOLDOWN}s: {e}")
+
+async def _get_cached_many(keys: list[tuple]) -> list[Optional[dict]]:
+    """
+    検索結果キャッシュから複数の値を1往復でまとめて取得します。期限切れ・未登録のキーはNoneになります。
+    """
+    if _use_redis():
+        try:
+            cached = await _get_cached_script(
+                keys=[SEARCH_CACHE_GENERATION_KEY],
+                args=[SEARCH_CACHE_PREFIX, *(_redis_key(key) for key in keys)]
+            )
+            return [orjson.loads(value) if value is not None else None for value in cached]
+        except redis.RedisError as e:
+            # キャッシュの障害で検索自体は失敗させない
+            _on_redis_error("reading", e)
+    async with _search_cache_lock:
+        return [_search_cache.get(key) for key in keys]
+
+async def _get_cached(key: tuple) -> Optional[dict]:
+    """
+    検索結果キャッシュから値を取得します。期限切れ・未登録の場合はNoneを返します。
+    """
+    cached, = await _get_cached_many([key])
+    return cached
+
+async def _set_cached(key: tuple, value: dict) -> None:
+    """
+    検索結果キャッシュに値を登録します。
+    """
+    if _use_redis():
+        try:
+            await _set_cached_script(
+                keys=[SEARCH_CACHE_GENERATION_KEY],
+                args=[SEARCH_CACHE_PREFIX, _redis_key(key), orjson.dumps(value), SEARCH_CACHE_TTL]
+            )
+            return
+        except redis.RedisError as e:
+            _on_redis_error("writing", e)
+    async with _search_cache_lock:
+        _search_cache[key] = value
+
+def _build_search_query(q: str) -> dict:
+    """
+    `/search` 用のElasticsearch検索クエリを作成します。
+    """
+    # クローラーが行ごとに索引した `links` を対象に `nested`クエリで検索し、
+    # キーワードを含む行のページタイトルを `inner_hits` として受け取る
+    return {
+        "query": {
+            "nested": {
+                "path": "links",
+                "query": {
+                    "match": {
+                        "links.line_text": {
+                            "query": q,
+                            "operator": "and"  # AND検索で検索精度を向上
+                        }
+                    }
+                },
+                "inner_hits": {
+                    "size": MAX_LINKS_PER_PAGE,  # 1ドキュメントあたりの行数の上限
+                    "sort": [{"links.line_no": "asc"}],  # 本文中の行順で返す
+                    "_source": False,
+                    "docvalue_fields": ["links.page_title"]
+                }
+            }
+        },
+        "_source": False,
+        "track_total_hits": False,  # 総ヒット数は使わないため集計させない
+        "size": 10  # 取得するドキュメント数の上限
+    }
+
+def _check_result_window(page: int, size: int) -> None:
+    """
+    ページ指定がElasticsearchで取得可能な範囲 (from + size <= max_result_window) に収まるか確認します。
+    """
+    if (page + 1) * size > MAX_RESULT_WINDOW:
+        raise HTTPException(
+            status_code=400,
+            detail=f"'page' and 'size' must satisfy (page + 1) * size <= {MAX_RESULT_WINDOW}."
+        )
+
+def _build_file_list_query(q: str, page: int, size: int) -> dict:
+    """
+    `/search_file_list` 用のElasticsearch検索クエリを作成します。
+    """
+    return {
+        "query": {
+            "match": {
+                "body": {
+                    "query": q,
+                    "operator": "and"
+                }
+            }
+        },
+        # ヒット数はterm vectorsから集計するため、表示に使うタイトルだけを取得
+        "_source": {"includes": ["title"]},
+        "track_total_hits": False,  # 総ヒット数は使わないため集計させない
+        "from": page * size,
+        "size": size
+    }
+
+def _shape_search_response(response: dict, q: str) -> dict:
+    """
+    Elasticsearchの検索結果から、キーワードを含む行のページタイトルを重複なく取り出して整形します。
+    """
+    all_matched_pages = []
+    seen_pages = set()
+    # ヒットした各ドキュメントの、キーワードを含む行をループ処理
+    for hit in response['hits']['hits']:
+        for link in hit['inner_hits']['links']['hits']['hits']:
+            page = link['fields']['links.page_title'][0]
+            # 全体の結果リストに結合し、重複を排除
+            if page not in seen_pages:
+                seen_pages.add(page)
+                all_matched_pages.append(page)
+
+    return {"query": q, "results": all_matched_pages}
+
+async def _analyze_query(q: str) -> list[str]:
+    """
+    bodyと同じアナライザーで検索語をトークンに分割します。
+
     Args:
-        body_text (str): Elasticsearchから取得したbodyフィールドのテキスト。
-        keyword (str): ユーザーが指定した検索キーワード。
-    
+        q (str): ユーザーが指定した検索キーワード。
+
     Returns:
-        list[str]: 抽出されたページタイトルのリスト（重複なし）。
+        list[str]: 小文字化済みのトークンのリスト (複合語のトークンは除く)。
+    """
+    analyzed = await es_client.indices.analyze(index=INDEX_NAME, body={"field": "body", "text": q})
+    # kuromojiのsearchモードは複合語 (例: 関西国際空港) を、分割したトークン (関西/国際/空港) に
+    # 重ねても出力する。重複して数えないよう、複数の位置にまたがるトークンは除く
+    return [token["token"] for token in analyzed["tokens"] if token.get("positionLength", 1) == 1]
+
+async def _count_terms(response: dict, tokens: list[str]) -> dict[str, int]:
+    """
+    検索にヒットした各ドキュメントについて、検索語の出現回数をElasticsearch側で集計します。
+
+    - 出現回数は、検索語を分割したトークンごとの `body` のterm vectorsの `term_freq` の合計です。
+      部分文字列ではなくトークン単位で数えます。
+    - 複合語の検索語は、重なり合う複合語トークンを除いた分割後の各トークンで数えます。
+      例えば「関西国際空港」は 関西/国際/空港 の出現回数の合計になり、1回の出現は3と数えられ、
+      「空港」だけが現れる箇所も1と数えられます。
+    - アナライザーに `lowercase` フィルタがあるため、大文字/小文字は区別しません。
+    - レスポンスには各ドキュメントの全トークンが含まれます。
+
+    Args:
+        response (dict): `/search_file_list` 用クエリの検索結果。
+        tokens (list[str]): `_analyze_query` で分割した検索語のトークン。
+
+    Returns:
+        dict[str, int]: ドキュメントIDごとの検索語の出現回数の合計。
+    """
+    ids = [hit["_id"] for hit in response['hits']['hits']]
+    if not ids:
+        return {}
+
+    # 本文を転送せず、索引済みのterm vectorsから単語ごとの出現回数だけを取得する
+    term_vectors = await es_client.mtermvectors(index=INDEX_NAME, body={
+        "ids": ids,
+        "parameters": {
+            "fields": ["body"],
+            "term_statistics": False,
+            "field_statistics": False,
+            "offsets": False,
+            "positions": False,
+            "payloads": False
+        }
+    })
+    counts = {}
+    for doc in term_vectors["docs"]:
+        terms = doc.get("term_vectors", {}).get("body", {}).get("terms", {})
+        counts[doc["_id"]] = sum(terms[token]["term_freq"] for token in tokens if token in terms)
+    return counts
+
+def _shape_file_list_response(response: dict, q: str, counts: dict[str, int]) -> dict:
+    """
+    Elasticsearchの検索結果と検索語の出現回数から、ファイルリストを整形します。
     """
     results = []
-    # [[ページ名]] の形式を抽出するための正規表現パターン
-    pattern = re.compile(r"\[\[(.*?)\]\]")
-    
-    for line in body_text.splitlines():
-        # 行にキーワードが含まれているかチェック (大文字/小文字を無視)
-        if keyword.lower() in line.lower():
-            match = pattern.search(line)
-            if match:
-                page_title = match.group(1)
-                # 結果リストに重複がなければ追加
-                if page_title not in results:
-                    results.append(page_title)
-    return results
+    for hit in response['hits']['hits']:
+        count = counts.get(hit["_id"], 0)
+        title = hit['_source'].get('title') or hit["_id"]
+        results.append({
+            "id": hit["_id"],
+            "title": title,
+            "count": count,
+            "score": hit.get("_score", 0)
+        })
+    # Elasticsearchがスコアの降順で返すため、ヒット順のまま返す
+    return {
+        "query": q,
+        "total": len(results),
+        "results": results
+    }
 
 # --- APIエンドポイント定義 ---
 @app.get("/search", tags=["Search"])
-async def search_wiki(q: Optional[str] = Query(None, description="検索キーワード", min_length=1)):
+async def search_wiki(q: Optional[str] = Query(None, description="検索キーワード", min_length=1)) -> SearchResponse:
     """
     指定されたキーワードでWikiのページを検索します。
 
-    - `body` フィールドに対して全文検索を行います。
-    - 検索にヒットしたドキュメントの中から、キーワードを含む行を特定し、その行のページタイトルを返します。
+    - クローラーが索引した `[[ページ名]]` を含む行に対して全文検索を行います。
+    - キーワードを含む行のページタイトルを返します。
+    - 1ページあたり、キーワードを含むリンク行は先頭から最大100行 (`MAX_LINKS_PER_PAGE`) までが対象です。
+      それ以降の行のページタイトルは結果に含まれません。
     """
     if es_client is None:
         raise HTTPException(status_code=503, detail="Elasticsearch service is unavailable.")
@@ -90,38 +373,16 @@ async def search_wiki(q: Optional[str] = Query(None, description="検索キー
     if not q:
         raise HTTPException(status_code=400, detail="Query parameter 'q' is required.")
 
-    try:
-        # Elasticsearchの検索クエリを作成
-        # `match`クエリで`body`フィールドを対象に検索
-        query = {
-            "query": {
-                "match": {
-                    "body": {
-                        "query": q,
-                        "operator": "and"  # AND検索で検索精度を向上
-                    }
-                }
-            },
-            "size": 10  # 取得するドキュメント数の上限
-        }
+    cache_key = ("search", q)
+    cached = await _get_cached(cache_key)
+    if cached is not None:
+        return cached
 
-        response = es_client.search(index=INDEX_NAME, body=query)
-        
-        all_matched_pages = []
-        # ヒットした各ドキュメントをループ処理
-        for hit in response['hits']['hits']:
-            if 'body' in hit['_source']:
-                # bodyフィールドの内容を取得
-                body_content = "\n".join(hit['_source']['body']) if isinstance(hit['_source']['body'], list) else hit['_source']['body']
-                # bodyからキーワードにマッチするページ名を抽出
-                pages = parse_wiki_body(body_content, q)
-                
-                # 全体の結果リストに結合し、重複を排除
-                for page in pages:
-                    if page not in all_matched_pages:
-                        all_matched_pages.append(page)
-
-        return {"query": q, "results": all_matched_pages}
+    try:
+        response = await es_client.search(index=INDEX_NAME, body=_build_search_query(q))
+        result = _shape_search_response(response, q)
+        await _set_cached(cache_key, result)
+        return result
 
     except Exception as e:
         # Elasticsearchからのエラーやその他の例外をハンドル
@@ -129,52 +390,95 @@ async def search_wiki(q: Optional[str] = Query(None, description="検索キー
 
 @app.get("/search_file_list", tags=["Search"])
 async def search_file_list(
-    q: str = Query(..., description="検索キーワード", min_length=1)
-) -> JSONResponse:
+    q: str = Query(..., description="検索キーワード", min_length=1),
+    page: int = Query(0, description="ページ番号 (0始まり)", ge=0),
+    size: int = Query(20, description="1ページあたりの件数", ge=1, le=100)
+) -> FileListResponse:
     """
-    指定キーワードでファイルリストを検索し、ヒット数順に返す。
+    指定キーワードでファイルリストを検索し、Elasticsearchのスコア順 (降順) にページ単位で返す。
+
+    - `count` は各ファイル内の検索語の出現回数で、並び順には影響しません。
     """
     if es_client is None:
         raise HTTPException(status_code=503, detail="Elasticsearch service is unavailable.")
     if not q:
         raise HTTPException(status_code=400, detail="Query parameter 'q' is required.")
+    _check_result_window(page, size)
+
+    cache_key = ("search_file_list", page, size, q)
+    cached = await _get_cached(cache_key)
+    if cached is not None:
+        return cached
 
     try:
-        query = {
-            "query": {
-                "match": {
-                    "body": {
-                        "query": q,
-                        "operator": "and"
-                    }
-                }
-            },
-            "size": 100
-        }
-        response = es_client.search(index=INDEX_NAME, body=query)
-        results = []
-        for hit in response['hits']['hits']:
-            body = hit['_source'].get('body', '')
-            if isinstance(body, list):
-                body_text = "\n".join(body)
+        # 検索語の分割は検索結果に依存しないため、検索と同時に行う
+        response, tokens = await asyncio.gather(
+            es_client.search(index=INDEX_NAME, body=_build_file_list_query(q, page, size)),
+            _analyze_query(q)
+        )
+        counts = await _count_terms(response, tokens)
+        result = _shape_file_list_response(response, q, counts)
+        await _set_cached(cache_key, result)
+        return result
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred during the search: {str(e)}")
+
+@app.get("/search_combined", tags=["Search"])
+async def search_combined(
+    q: str = Query(..., description="検索キーワード", min_length=1),
+    page: int = Query(0, description="ファイルリストのページ番号 (0始まり)", ge=0),
+    size: int = Query(20, description="ファイルリストの1ページあたりの件数", ge=1, le=100)
+) -> CombinedResponse:
+    """
+    `/search` と `/search_file_list` の結果をまとめて返す。
+
+    - 2つの検索を `_msearch` の1リクエストにまとめてElasticsearchに送信します。
+    """
+    if es_client is None:
+        raise HTTPException(status_code=503, detail="Elasticsearch service is unavailable.")
+    if not q:
+        raise HTTPException(status_code=400, detail="Query parameter 'q' is required.")
+    _check_result_window(page, size)
+
+    search_key = ("search", q)
+    file_list_key = ("search_file_list", page, size, q)
+    search_result, file_list_result = await _get_cached_many([search_key, file_list_key])
+
+    try:
+        # キャッシュにない検索だけをまとめて送信する
+        searches = []
+        if search_result is None:
+            searches += [{}, _build_search_query(q)]
+        if file_list_result is None:
+            searches += [{}, _build_file_list_query(q, page, size)]
+
+        if searches:
+            if file_list_result is None:
+                # 検索語の分割は検索結果に依存しないため、検索と同時に行う
+                response, tokens = await asyncio.gather(
+                    es_client.msearch(index=INDEX_NAME, body=searches),
+                    _analyze_query(q)
+                )
             else:
-                body_text = body
-            # 検索語ごとにカウント
-            count = sum(body_text.lower().count(word.lower()) for word in q.split())
-            title = hit['_source'].get('title') or hit["_id"]
-            results.append({
-                "id": hit["_id"],
-                "title": title,
-                "count": count,
-                "score": hit.get("_score", 0)
-            })
-        # スコア順で降順ソート
-        sorted_results = sorted(results, key=lambda x: (x["score"], x["count"]), reverse=True)
-        return JSONResponse(content={
+                response = await es_client.msearch(index=INDEX_NAME, body=searches)
+            responses = iter(response['responses'])
+            for item in response['responses']:
+                if 'error' in item:
+                    raise RuntimeError(item['error'])
+            if search_result is None:
+                search_result = _shape_search_response(next(responses), q)
+                await _set_cached(search_key, search_result)
+            if file_list_result is None:
+                file_list_response = next(responses)
+                counts = await _count_terms(file_list_response, tokens)
+                file_list_result = _shape_file_list_response(file_list_response, q, counts)
+                await _set_cached(file_list_key, file_list_result)
+
+        return {
             "query": q,
-            "total": len(sorted_results),
-            "results": sorted_results
-        })
+            "search": search_result,
+            "file_list": file_list_result
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred during the search: {str(e)}")
 
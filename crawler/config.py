@@ -3,8 +3,18 @@ class pukiwiki:
     # Docker Compose内のサービス名'elasticsearch'を指定
     ELASTIC_SEARCH_ENDPOINT = "http://elasticsearch:9200"
     # 作成するインデックス名
-    INDEX = "pukiwiki"
+    # index.json のマッピング・アナライザーを変更したら版を上げる
+    # (新しいインデックスが作られ、次のクロールで全ページが再送される)
+    INDEX = "pukiwiki_v2"
+    # 新しいインデックスの作成後に削除する旧版のインデックス名
+    LEGACY_INDICES = ["pukiwiki"]
     # インデックス設定ファイルのコンテナ内パス
     INDEX_FILE = "/app/index.json"
     # PukiWikiデータディレクトリのコンテナ内パス
-    PUKIWIKI_DATA_DIR = "/pukiwiki_data"
\ No newline at end of file
+    PUKIWIKI_DATA_DIR = "/pukiwiki_data"
+    # 検索APIがキャッシュに使うRedisのURL (Noneの場合はキャッシュを無効化しない)
+    REDIS_URL = None
+    # 再インデックス後にINCRする検索結果キャッシュの世代番号のキー (api/main.py と合わせる)
+    SEARCH_CACHE_GENERATION_KEY = "wiki_search:generation"
+    # Redisの接続・応答待ちの上限 (秒)
+    REDIS_TIMEOUT = 3
\ No newline at end of file
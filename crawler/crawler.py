@@ -2,31 +2,51 @@ import argparse
 import glob
 import json
 import os
+import re
 import urllib.parse
 from urllib.error import HTTPError
 
+import ijson
+import redis
+
 from config import pukiwiki as config
 from els.client import ElsClient
 
 client = ElsClient(config.ELASTIC_SEARCH_ENDPOINT, config.INDEX)
 
+# [[page]] link in pukiwiki text
+WIKI_LINK_RE = re.compile(r"\[\[(.*?)\]\]")
+
 def add_index(args):
     # Add index if not exists
     try:
-        client.get_index()
+        # body is not read; return the connection to the pool
+        client.get_index().drain_conn()
     except HTTPError as e:
         if e.status == 404:
             with open(config.INDEX_FILE) as f:
                 print(client.add_index(f.read()).read().decode("utf-8"))
+            _delete_legacy_indices()
         else:
             raise
 
+def _delete_legacy_indices():
+    # indices created from an older index.json are no longer searched;
+    # pages are re-sent to the new index by the next crawl
+    for index_name in config.LEGACY_INDICES:
+        legacy_client = ElsClient(config.ELASTIC_SEARCH_ENDPOINT, index_name)
+        print(legacy_client.delete_index().read().decode("utf-8"))
+
 
 def delete_index(args):
     print(client.delete_index().read().decode("utf-8"))
 
 
 def crawl(args):
+    # create the index from index.json before indexing, otherwise els
+    # creates it with dynamic mappings (e.g. links as object, not nested)
+    add_index(args)
+
     all_query = {
             "sort": { "modified": "desc" },
             "query": {"match_all": {}},
@@ -36,15 +56,7 @@ def crawl(args):
             "size": 10000
             }
 
-    all_entries = json.loads(
-            client.search(json.dumps(all_query)).read().decode("utf-8")
-            )
-    if all_entries["hits"]["total"]["relation"] in ("gte", "eq") and all_entries["hits"]["total"]["value"] > 0:
-        last_modified = all_entries["hits"]["hits"][0]["_source"]["modified"]
-    else:
-        last_modified = 0
-
-    els_ids = set(map(lambda x: x["_id"], all_entries["hits"]["hits"]))
+    last_modified, els_ids = _get_indexed_entries(all_query)
 
     paths = glob.glob(os.path.join(config.PUKIWIKI_DATA_DIR, "*.txt"))
 
@@ -78,6 +90,40 @@ def crawl(args):
             }
     print(client.delete_by_query(json.dumps(deleted_page_query)).read().decode("utf-8"))
 
+    _bump_cache_generation()
+
+def _bump_cache_generation():
+    # cached search results are keyed by this generation, so bumping it
+    # makes the api ignore results cached before this crawl
+    if not config.REDIS_URL:
+        return
+    r = redis.Redis.from_url(
+            config.REDIS_URL,
+            socket_timeout=config.REDIS_TIMEOUT,
+            socket_connect_timeout=config.REDIS_TIMEOUT
+            )
+    try:
+        print(f"Search cache generation: {r.incr(config.SEARCH_CACHE_GENERATION_KEY)}")
+    except (redis.RedisError, OSError) as e:
+        # the index is already updated; stale cache expires by ttl
+        print(f"Failed to bump search cache generation: {e}")
+    finally:
+        r.close()
+
+def _get_indexed_entries(all_query):
+    # stream-decode the response so that up to 10000 hits are never
+    # materialized as one json tree
+    last_modified = None
+    els_ids = set()
+    for prefix, event, value in ijson.parse(client.search_stream(all_query)):
+        if prefix == "hits.hits.item._id":
+            els_ids.add(value)
+        elif prefix == "hits.hits.item._source.modified" and last_modified is None:
+            # hits are sorted by modified desc
+            last_modified = int(value)
+
+    return last_modified or 0, els_ids
+
 def _create_page_json_for_bulk(data):
     # use filename as _id
     head = json.dumps({"index" : { "_index": config.INDEX, "_id": data.pop("filename") }})
@@ -98,12 +144,27 @@ def _get_page_data(path):
 
     return {
             "body": body,
+            "links": _get_links(body),
             "title": title,
             "title_url_encoded": title_url_encoded,
             "modified": modified,
             "filename": filename
             }
 
+def _get_links(body):
+    # index the first [[page]] of each line together with the line,
+    # so the api can search link lines without scanning the body
+    links = []
+    for line_no, line in enumerate(body.splitlines()):
+        match = WIKI_LINK_RE.search(line)
+        if match:
+            links.append({
+                "line_no": line_no,
+                "line_text": line,
+                "page_title": match.group(1)
+                })
+    return links
+
 def _get_page_title(filename):
     # utf-8 encode <- pukiwiki hex title
     #
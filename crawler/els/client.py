@@ -1,13 +1,18 @@
 # crawler/els/client.py
-import urllib.request
+import io
+import json
 from urllib.error import HTTPError
 
+import urllib3
+
 class ElsClient:
-    """urllibを使ったシンプルなElasticsearchクライアント"""
+    """urllib3のコネクションプールを使ったシンプルなElasticsearchクライアント"""
     def __init__(self, endpoint, index_name):
         self.endpoint = endpoint
         self.index_name = index_name
         self.base_url = f"{self.endpoint}/{self.index_name}"
+        # リクエストごとに接続し直さないよう、keep-aliveで接続を使い回す
+        self._http = urllib3.PoolManager(num_pools=4, maxsize=16)
 
     def _request(self, method, path, data=None, ctype="application/json"):
         url = f"{self.endpoint}{path}"
@@ -15,8 +20,13 @@ class ElsClient:
         
         body = data.encode('utf-8') if data else None
         
-        req = urllib.request.Request(url, data=body, headers=headers, method=method)
-        return urllib.request.urlopen(req)
+        # 呼び出し側で.read()できるよう、レスポンス本文は読み込まずに返す
+        # 本文を最後まで読まない呼び出し側は drain_conn() で接続をプールに戻すこと
+        resp = self._http.request(method, url, body=body, headers=headers, preload_content=False)
+        if resp.status >= 400:
+            # urllibと同じくエラー時はHTTPErrorを送出する
+            raise HTTPError(url, resp.status, resp.reason, resp.headers, io.BytesIO(resp.read()))
+        return resp
 
     def get_index(self):
         return self._request("GET", f"/{self.index_name}")
@@ -33,8 +43,13 @@ class ElsClient:
                 return e
             raise
 
-    def search(self, query_json):
-        return self._request("POST", f"/{self.index_name}/_search", data=query_json)
+    def search(self, query):
+        # クエリはdictで受け取り、レスポンスもデコード済みのdictで返す
+        return json.loads(self.search_stream(query).read())
+
+    def search_stream(self, query):
+        # 大きなレスポンスを逐次パースできるよう、本文を読み込まずに返す
+        return self._request("POST", f"/{self.index_name}/_search", data=json.dumps(query))
 
     def bulk(self, bulk_data):
         # Bulk APIはContent-Typeが異なる
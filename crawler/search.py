@@ -2,7 +2,6 @@
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import json
 
 # crawler.py と同じ設定とクライアントクラスをインポート
 from config import pukiwiki as config
@@ -17,8 +16,8 @@ CORS(app)
 # --- Elasticsearchクライアントの初期化 ---
 try:
     client = ElsClient(config.ELASTIC_SEARCH_ENDPOINT, config.INDEX)
-    # 接続テスト
-    client.get_index() 
+    # 接続テスト (本文は読まないため、接続をプールに戻す)
+    client.get_index().drain_conn()
     print("Successfully connected to Elasticsearch.")
 except Exception as e:
     print(f"Error: Failed to connect to Elasticsearch. {e}")
@@ -65,8 +64,7 @@ def search():
 
     try:
         # Elasticsearchに検索リクエストを送信
-        response = client.search(json.dumps(query)).read().decode("utf-8")
-        raw_results = json.loads(response)
+        raw_results = client.search(query)
 
         # フロントエンドで使いやすいように結果を整形
         hits = []